@@ -1,208 +1,341 @@
 import json
-import boto3
 import os
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import botocore.session
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-def handler(event, context):
+# PutMetricData accepts up to 1000 MetricDatum items per request
+CW_MAX_BATCH = 1000
+
+_UNIT_COUNT = 'Count'
+_UNIT_PCT = 'Percent'
+
+# One worker per concurrent EC2 lookup: subnets, ENIs and route tables
+DESCRIBE_WORKERS = 3
+
+# Per-subnet datapoints can be turned off to ship only the per-SubnetType rollups
+PUBLISH_SUBNET_METRICS = os.environ.get('PUBLISH_SUBNET_METRICS', 'true').lower() == 'true'
+
+# Log the full per-subnet report on success instead of a one-line summary
+VERBOSE_REPORT = os.environ.get('VERBOSE_REPORT', 'false').lower() == 'true'
+
+# How long (seconds) a VPC's subnet classification is reused across warm
+# invocations. It must be well above the schedule interval, or the cache
+# expires just before each scheduled run; a route table change can take
+# this long to show up in SubnetType
+ROUTE_TABLE_CACHE_TTL = int(os.environ.get('ROUTE_TABLE_CACHE_TTL', '1800'))
+
+# vpc_id -> (fetched_at, subnet_types, main_type); lives for the execution environment
+_RT_CACHE = {}
+
+# Error codes EC2 uses when a caller exceeds its API request rate
+THROTTLING_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+# Shared clients are created once per execution environment and reused
+# across warm invocations (urllib3 reuses their pooled HTTPS connections);
+# the connection pool matches the describe workers. tcp_keepalive only sets
+# SO_KEEPALIVE so the kernel can detect dead peers on long-idle sockets
+BOTO_CONFIG = Config(
+    max_pool_connections=DESCRIBE_WORKERS,
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    tcp_keepalive=True
+)
+
+# botocore is used directly; the boto3 session/resource layer adds import time
+# and nothing here needs it
+_session = botocore.session.get_session()
+ec2 = _session.create_client('ec2', config=BOTO_CONFIG)
+cloudwatch = _session.create_client('cloudwatch', config=BOTO_CONFIG)
+
+def _chunk(items, size):
+    """Yield successive lists of at most `size` items"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _usable_ips(cidr):
+    """Number of addresses in an IPv4 CIDR block minus the 5 AWS reserves"""
+    return (1 << (32 - int(cidr.split('/', 1)[1]))) - 5
+
+
+def _describe_subnets(vpc_id):
+    """Return every subnet in a VPC using the largest page size the API allows"""
+    paginator = ec2.get_paginator('describe_subnets')
+    pages = paginator.paginate(
+        Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}],
+        PaginationConfig={'PageSize': 1000}
+    )
+    return [subnet for page in pages for subnet in page['Subnets']]
+
+
+def _count_network_interfaces(vpc_id):
+    """Count the ENIs in a VPC without holding every page of results in memory"""
+    paginator = ec2.get_paginator('describe_network_interfaces')
+    pages = paginator.paginate(
+        Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}],
+        PaginationConfig={'PageSize': 1000}
+    )
+    return sum(len(page['NetworkInterfaces']) for page in pages)
+
+
+def _is_public_route_table(rt):
+    """Whether the route table sends 0.0.0.0/0 to an internet gateway"""
+    return any(
+        route.get('DestinationCidrBlock') == '0.0.0.0/0' and route.get('GatewayId', '').startswith('igw-')
+        for route in rt.get('Routes', [])
+    )
+
+
+def _subnet_types(vpc_id):
     """
-    Lambda function to monitor IP allocation in VPC and send metrics to CloudWatch
-    Alerts are handled by CloudWatch alarms, not this Lambda
+    Classify the VPC's subnets as public/private from its route tables
+
+    Returns (subnet_types, main_type) where subnet_types maps explicitly
+    associated subnet IDs to their type and main_type applies to every other
+    subnet. Results are cached for ROUTE_TABLE_CACHE_TTL seconds; an expired
+    entry is still reused if the refresh is throttled.
     """
-    ec2 = boto3.client('ec2')
-    cloudwatch = boto3.client('cloudwatch')
-    
-    vpc_id = os.environ['VPC_ID']
-    
+    cached = _RT_CACHE.get(vpc_id)
+    if cached and time.monotonic() - cached[0] < ROUTE_TABLE_CACHE_TTL:
+        return cached[1], cached[2]
+
+    subnet_types = {}
+    main_type = "private"
     try:
-        # Get VPC information
-        vpc_response = ec2.describe_vpcs(VpcIds=[vpc_id])
-        vpc_cidr = vpc_response['Vpcs'][0]['CidrBlock']
-        
-        # Calculate total IPs in VPC (excluding AWS reserved IPs)
-        import ipaddress
-        network = ipaddress.IPv4Network(vpc_cidr)
-        total_ips = network.num_addresses - 5  # AWS reserves 5 IPs per subnet
-        
-        # Get subnets in VPC
-        subnets_response = ec2.describe_subnets(
-            Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]
-        )
-        
-        used_ips = 0
-        subnet_details = []
-        
-        for subnet in subnets_response['Subnets']:
-            subnet_id = subnet['SubnetId']
-            subnet_cidr = subnet['CidrBlock']
-            available_ips = subnet['AvailableIpAddressCount']
-            
-            # Calculate subnet size
-            subnet_network = ipaddress.IPv4Network(subnet_cidr)
-            subnet_total = subnet_network.num_addresses - 5
-            subnet_used = subnet_total - available_ips
-            
-            used_ips += subnet_used
-            
-            subnet_details.append({
-                'SubnetId': subnet_id,
-                'CIDR': subnet_cidr,
-                'TotalIPs': subnet_total,
-                'UsedIPs': subnet_used,
-                'AvailableIPs': available_ips,
-                'UtilizationPercent': (subnet_used / subnet_total) * 100 if subnet_total > 0 else 0
-            })
-        
-        available_ips = total_ips - used_ips
-        utilization_percent = (used_ips / total_ips) * 100 if total_ips > 0 else 0
-        
-        # Get ENI information for detailed IP usage tracking
-        enis_response = ec2.describe_network_interfaces(
-            Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}]
+        # Fetch every route table in the VPC once and map subnets to them locally
+        # (DescribeRouteTables caps MaxResults at 100)
+        paginator = ec2.get_paginator('describe_route_tables')
+        pages = paginator.paginate(
+            Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}],
+            PaginationConfig={'PageSize': 100}
         )
-        
-        eni_count = len(enis_response['NetworkInterfaces'])
-        
-        # Send metrics to CloudWatch (per-subnet and VPC-level)
-        metrics = []
-        
-        # Per-subnet metrics with SubnetId and VpcId dimensions
-        for subnet_detail in subnet_details:
-            subnet_id = subnet_detail['SubnetId']
-            
+        for page in pages:
+            for rt in page['RouteTables']:
+                rt_type = "public" if _is_public_route_table(rt) else "private"
+                for assoc in rt.get('Associations', []):
+                    if assoc.get('SubnetId'):
+                        subnet_types[assoc['SubnetId']] = rt_type
+                    elif assoc.get('Main'):
+                        main_type = rt_type
+    except ClientError as e:
+        # Throttling that outlasted the SDK's adaptive retries falls back to the
+        # expired cache entry if there is one, keeping SubnetType dimensions stable,
+        # and only to "private" on a cold cache; anything else fails
+        code = e.response['Error']['Code']
+        if code not in THROTTLING_ERROR_CODES:
+            raise
+        if cached:
+            age = int(time.monotonic() - cached[0])
+            print(f"Throttled describing route tables for {vpc_id} ({code}), reusing classification from {age}s ago")
+            return cached[1], cached[2]
+        print(f"Throttled describing route tables for {vpc_id} ({code}), reporting subnets as private")
+        return {}, "private"
+
+    _RT_CACHE[vpc_id] = (time.monotonic(), subnet_types, main_type)
+    return subnet_types, main_type
+
+
+def compute_metrics_for_vpc(vpc_id, now):
+    """
+    Collect IP allocation for a VPC, publish the metrics to CloudWatch
+    and return a report of what was sent
+
+    `now` is the invocation's timestamp, applied to every datapoint
+    """
+    # Subnet, ENI and route table lookups are independent, so issue them concurrently
+    with ThreadPoolExecutor(max_workers=DESCRIBE_WORKERS) as pool:
+        subnets_future = pool.submit(_describe_subnets, vpc_id)
+        eni_count_future = pool.submit(_count_network_interfaces, vpc_id)
+        subnet_types_future = pool.submit(_subnet_types, vpc_id)
+
+        subnets = subnets_future.result()
+        # ENI information for detailed IP usage tracking
+        eni_count = eni_count_future.result()
+        # Subnets without an explicit route table association use the main route table
+        subnet_types, main_type = subnet_types_future.result()
+
+    # VPC totals are summed from its subnets, which covers secondary CIDRs
+    # and excludes address space not allocated to any subnet
+    total_ips = 0
+    used_ips = 0
+    subnet_details = []
+
+    for subnet in subnets:
+        subnet_id = subnet['SubnetId']
+        subnet_cidr = subnet['CidrBlock']
+        available_ips = subnet['AvailableIpAddressCount']
+
+        # Calculate subnet size
+        subnet_total = _usable_ips(subnet_cidr)
+        subnet_used = subnet_total - available_ips
+
+        total_ips += subnet_total
+        used_ips += subnet_used
+
+        subnet_details.append({
+            'SubnetId': subnet_id,
             # Determine subnet type (private/public) based on route table
-            subnet_type = "private"  # default assumption
-            try:
-                # Check if subnet has route to internet gateway (indicates public subnet)
-                route_tables = ec2.describe_route_tables(
-                    Filters=[
-                        {'Name': 'association.subnet-id', 'Values': [subnet_id]}
-                    ]
-                )
-                
-                for rt in route_tables['RouteTables']:
-                    for route in rt['Routes']:
-                        if route.get('DestinationCidrBlock') == '0.0.0.0/0' and 'GatewayId' in route and route['GatewayId'].startswith('igw-'):
-                            subnet_type = "public"
-                            break
-                    if subnet_type == "public":
-                        break
-            except Exception:
-                # If we can't determine, assume private
-                pass
-            
-            # Add per-subnet metric
-            subnet_metrics = [
+            'SubnetType': subnet_types.get(subnet_id, main_type),
+            'CIDR': subnet_cidr,
+            'TotalIPs': subnet_total,
+            'UsedIPs': subnet_used,
+            'AvailableIPs': available_ips,
+            'UtilizationPercent': (subnet_used / subnet_total) * 100 if subnet_total > 0 else 0
+        })
+
+    available_ips = total_ips - used_ips
+    utilization_percent = (used_ips / total_ips) * 100 if total_ips > 0 else 0
+
+    # Send metrics to CloudWatch (per-subnet and VPC-level), every datapoint
+    # from this run stamped with the same time
+    metrics = []
+    vpc_dims = [{'Name': 'VpcId', 'Value': vpc_id}]
+
+    # Per-subnet metrics with SubnetId and VpcId dimensions
+    if PUBLISH_SUBNET_METRICS:
+        for subnet_detail in subnet_details:
+            dims = [
+                vpc_dims[0],
+                {'Name': 'SubnetId', 'Value': subnet_detail['SubnetId']},
+                {'Name': 'SubnetType', 'Value': subnet_detail['SubnetType']}
+            ]
+            metrics.extend((
                 {
                     'MetricName': 'SubnetTotalIPs',
                     'Value': subnet_detail['TotalIPs'],
-                    'Unit': 'Count',
-                    'Dimensions': [
-                        {'Name': 'VpcId', 'Value': vpc_id},
-                        {'Name': 'SubnetId', 'Value': subnet_id},
-                        {'Name': 'SubnetType', 'Value': subnet_type}
-                    ]
+                    'Unit': _UNIT_COUNT,
+                    'Dimensions': dims,
+                    'Timestamp': now
                 },
                 {
                     'MetricName': 'SubnetUsedIPs',
                     'Value': subnet_detail['UsedIPs'],
-                    'Unit': 'Count',
-                    'Dimensions': [
-                        {'Name': 'VpcId', 'Value': vpc_id},
-                        {'Name': 'SubnetId', 'Value': subnet_id},
-                        {'Name': 'SubnetType', 'Value': subnet_type}
-                    ]
+                    'Unit': _UNIT_COUNT,
+                    'Dimensions': dims,
+                    'Timestamp': now
                 },
                 {
                     'MetricName': 'SubnetAvailableIPs',
                     'Value': subnet_detail['AvailableIPs'],
-                    'Unit': 'Count',
-                    'Dimensions': [
-                        {'Name': 'VpcId', 'Value': vpc_id},
-                        {'Name': 'SubnetId', 'Value': subnet_id},
-                        {'Name': 'SubnetType', 'Value': subnet_type}
-                    ]
+                    'Unit': _UNIT_COUNT,
+                    'Dimensions': dims,
+                    'Timestamp': now
                 },
                 {
                     'MetricName': 'SubnetIPUtilizationPercent',
                     'Value': subnet_detail['UtilizationPercent'],
-                    'Unit': 'Percent',
-                    'Dimensions': [
-                        {'Name': 'VpcId', 'Value': vpc_id},
-                        {'Name': 'SubnetId', 'Value': subnet_id},
-                        {'Name': 'SubnetType', 'Value': subnet_type}
-                    ]
+                    'Unit': _UNIT_PCT,
+                    'Dimensions': dims,
+                    'Timestamp': now
                 }
-            ]
-            metrics.extend(subnet_metrics)
-            
-            # Update subnet_detail with type for logging
-            subnet_detail['SubnetType'] = subnet_type
-        
-        # VPC-level aggregate metrics (keep existing for backward compatibility)
-        vpc_metrics = [
-            {
-                'MetricName': 'TotalIPs',
-                'Value': total_ips,
-                'Unit': 'Count',
-                'Dimensions': [{'Name': 'VpcId', 'Value': vpc_id}]
-            },
-            {
-                'MetricName': 'UsedIPs',
-                'Value': used_ips,
-                'Unit': 'Count',
-                'Dimensions': [{'Name': 'VpcId', 'Value': vpc_id}]
-            },
-            {
-                'MetricName': 'AvailableIPs',
-                'Value': available_ips,
-                'Unit': 'Count',
-                'Dimensions': [{'Name': 'VpcId', 'Value': vpc_id}]
-            },
-            {
-                'MetricName': 'IPUtilizationPercent',
-                'Value': utilization_percent,
-                'Unit': 'Percent',
-                'Dimensions': [{'Name': 'VpcId', 'Value': vpc_id}]
+            ))
+
+    # Per-SubnetType rollups carry the whole distribution in one datum each
+    for subnet_type in sorted({d['SubnetType'] for d in subnet_details}):
+        used = [d['UsedIPs'] for d in subnet_details if d['SubnetType'] == subnet_type]
+        metrics.append({
+            'MetricName': 'SubnetUsedIPs_bySubnetType',
+            'StatisticValues': {
+                'SampleCount': len(used),
+                'Sum': sum(used),
+                'Minimum': min(used),
+                'Maximum': max(used)
             },
-            {
-                'MetricName': 'ENICount',
-                'Value': eni_count,
-                'Unit': 'Count',
-                'Dimensions': [{'Name': 'VpcId', 'Value': vpc_id}]
-            }
-        ]
-        metrics.extend(vpc_metrics)
-        
-        # Send metrics to CloudWatch
+            'Unit': _UNIT_COUNT,
+            'Dimensions': [vpc_dims[0], {'Name': 'SubnetType', 'Value': subnet_type}],
+            'Timestamp': now
+        })
+
+    # VPC-level aggregate metrics (keep existing for backward compatibility)
+    metrics.extend((
+        {
+            'MetricName': 'TotalIPs',
+            'Value': total_ips,
+            'Unit': _UNIT_COUNT,
+            'Dimensions': vpc_dims,
+            'Timestamp': now
+        },
+        {
+            'MetricName': 'UsedIPs',
+            'Value': used_ips,
+            'Unit': _UNIT_COUNT,
+            'Dimensions': vpc_dims,
+            'Timestamp': now
+        },
+        {
+            'MetricName': 'AvailableIPs',
+            'Value': available_ips,
+            'Unit': _UNIT_COUNT,
+            'Dimensions': vpc_dims,
+            'Timestamp': now
+        },
+        {
+            'MetricName': 'IPUtilizationPercent',
+            'Value': utilization_percent,
+            'Unit': _UNIT_PCT,
+            'Dimensions': vpc_dims,
+            'Timestamp': now
+        },
+        {
+            'MetricName': 'ENICount',
+            'Value': eni_count,
+            'Unit': _UNIT_COUNT,
+            'Dimensions': vpc_dims,
+            'Timestamp': now
+        }
+    ))
+
+    # Send metrics to CloudWatch in as few requests as the API allows
+    for batch in _chunk(metrics, CW_MAX_BATCH):
         cloudwatch.put_metric_data(
             Namespace='Custom/IPMonitoring',
-            MetricData=metrics
+            MetricData=batch
         )
-        
-        # Prepare detailed report for logging
-        report = {
-            'timestamp': datetime.utcnow().isoformat(),
-            'vpc_id': vpc_id,
-            'vpc_cidr': vpc_cidr,
-            'total_ips': total_ips,
-            'used_ips': used_ips,
-            'available_ips': available_ips,
-            'utilization_percent': round(utilization_percent, 2),
-            'eni_count': eni_count,
-            'subnet_details': subnet_details
-        }
-        
-        print(f"IP monitoring completed successfully: {json.dumps(report, indent=2)}")
-        
+
+    # Prepare detailed report for logging
+    return {
+        'timestamp': now.isoformat(),
+        'vpc_id': vpc_id,
+        'total_ips': total_ips,
+        'used_ips': used_ips,
+        'available_ips': available_ips,
+        'utilization_percent': round(utilization_percent, 2),
+        'eni_count': eni_count,
+        'subnet_details': subnet_details
+    }
+
+
+def handler(event, context):
+    """
+    Lambda function to monitor IP allocation in VPC and send metrics to CloudWatch
+    Alerts are handled by CloudWatch alarms, not this Lambda
+    """
+    vpc_id = os.environ['VPC_ID']
+    now = datetime.now(timezone.utc)
+
+    try:
+        report = compute_metrics_for_vpc(vpc_id, now)
+
+        if VERBOSE_REPORT:
+            print(f"IP monitoring completed successfully: {json.dumps(report, separators=(',', ':'))}")
+        else:
+            print(
+                f"IP monitoring completed successfully vpc={vpc_id} "
+                f"used={report['used_ips']}/{report['total_ips']} eni={report['eni_count']}"
+            )
+
         return {
             'statusCode': 200,
             'body': json.dumps(report)
         }
-        
+
     except Exception as e:
         error_message = f"Error in IP monitoring: {str(e)}"
         print(error_message)
-        
+
         return {
             'statusCode': 500,
             'body': json.dumps({'error': error_message})
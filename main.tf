@@ -39,7 +39,10 @@ resource "aws_lambda_function" "ip_monitor" {
 
   environment {
     variables = {
-      VPC_ID = var.vpc_id
+      VPC_ID                 = var.vpc_id
+      PUBLISH_SUBNET_METRICS = tostring(var.publish_subnet_metrics)
+      VERBOSE_REPORT         = tostring(var.verbose_report)
+      ROUTE_TABLE_CACHE_TTL  = tostring(var.route_table_cache_ttl)
     }
   }
 
@@ -103,7 +106,6 @@ resource "aws_iam_role_policy" "lambda_ip_monitor_policy" {
       {
         Effect = "Allow"
         Action = [
-          "ec2:DescribeVpcs",
           "ec2:DescribeSubnets",
           "ec2:DescribeNetworkInterfaces",
           "ec2:DescribeRouteTables",
@@ -45,6 +45,24 @@ variable "critical_threshold" {
   default     = 90
 }
 
+variable "publish_subnet_metrics" {
+  description = "Publish per-subnet metrics in addition to the per-SubnetType rollups"
+  type        = bool
+  default     = true
+}
+
+variable "verbose_report" {
+  description = "Log the full per-subnet report on every run instead of a one-line summary"
+  type        = bool
+  default     = false
+}
+
+variable "route_table_cache_ttl" {
+  description = "Seconds a warm Lambda reuses the public/private subnet classification; keep it several times the monitoring_frequency interval"
+  type        = number
+  default     = 1800
+}
+
 variable "monitoring_frequency" {
   description = "How often to run IP monitoring (CloudWatch Events schedule expression)"
   type        = string